@@ -3,163 +3,191 @@ from google.api_core import exceptions as api_core_exceptions
 import sys
 import textwrap
 import argparse
+from typing import Optional
 
-DESTINATION_SCHEMA = [
-    bigquery.SchemaField("code", "STRING", mode="REQUIRED"),
-    bigquery.SchemaField("product_name", "STRING", mode="NULLABLE"), # Already present, ensuring it's correct
-    bigquery.SchemaField("summary", "STRING", mode="NULLABLE"),
-]
+EMBEDDING_MODEL_ID = "my_text_embedding_model-004"
+MAX_BYTES_BILLED = 50 * 10**9 # Guardrail against runaway scans (50 GB)
 
-def ensure_destination_table(client: bigquery.Client, table_id: str):
-    """Checks if the destination table exists and creates it if not."""
+def ensure_destination_table(client: bigquery.Client, table_id: str) -> bool:
+    """Checks if the destination table exists. If not, the first build's query creates it."""
     try:
         client.get_table(table_id)
         print(f"Table {table_id} already exists.") 
+        # Tables built before embeddings were fused in lack this column; adding it is metadata-only.
+        client.query(
+            f"ALTER TABLE `{table_id}` ADD COLUMN IF NOT EXISTS text_embedding ARRAY<FLOAT64>"
+        ).result()
+        return True
     except api_core_exceptions.NotFound:
-        print(f"Table {table_id} not found. Creating...")
-        table = bigquery.Table(table_id, schema=DESTINATION_SCHEMA)
-        table = client.create_table(table)
-        print(f"Created table {table.project}.{table.dataset_id}.{table.table_id}")
+        print(f"Table {table_id} not found. It will be created by the summary query.")
+        return False
 
-def build_summary_query(source_table: str, destination_table: str) -> str:
-    """Builds the BigQuery SQL script with the UDF to generate summaries."""
-    return textwrap.dedent(f"""
-        CREATE TEMP FUNCTION generate_summary(
-            product_name_json STRING, nutriments_json STRING, ingredients_text_str STRING, categories_tags_json STRING, additives_tags_json STRING, nutriscore_grade_str STRING, nova_group_val STRING
-        )
-        RETURNS STRING
-        LANGUAGE js AS r'''
-            function extractList(jsonString, prefix, item_extractor) {{
-            if (!jsonString) return null;
-            let data_list;
-            try {{
-                const parsed = JSON.parse(jsonString);
-                data_list = parsed.list ? parsed.list.map(i => i.element) : parsed;
-                if (Array.isArray(data_list) && data_list.length > 0) {{
-                    const items = data_list.map(item_extractor).filter(Boolean);
-                    if (items.length > 0) {{
-                        return items.join(', ');
-                    }}
-                }}
-            }} catch (e) {{ /* Ignore parsing errors */ }}
-            return null;
-        }}
-
-        const summary_parts = [];
-
-        // Extract the English product name, with a fallback.
-        let product_name = "This product";
-        try {{
-            if (product_name_json) {{
-                const name_list = JSON.parse(product_name_json).list;
-                if (name_list) {{
-                    const en_name_obj = name_list.find(item => item.element && item.element.lang === 'en');
-                    if (en_name_obj && en_name_obj.element.text) {{
-                        product_name = en_name_obj.element.text;
-                    }}
-                }}
-            }}
-        }} catch (e) {{ /* ignore errors, fallback to default */ }}
-
-        // Part 1: Categories
-        const category_items = extractList(categories_tags_json, '', item => {{
-            return item ? item.replace(/^en:/, '') : null;
-        }});
-        if (category_items) {{
-            summary_parts.push(product_name + " belongs to " + category_items + " category of products.");
-        }}
-
-        // Part 2: Ingredients
-        const ingredient_items = extractList(ingredients_text_str, '', item => {{
-            // Prefer 'en' text, but take any if 'en' is not available.
-            if (item && item.text && item.lang === 'en') return item.text;
-            return null; // Initially only consider 'en'
-        }}) || extractList(ingredients_text_str, '', item => item.text || null); // Fallback to any lang
-        if (ingredient_items) {{
-            summary_parts.push("Ingredients in " + product_name + " are " + ingredient_items + ".");
-        }}
-
-        // Part 3: Additives
-        const additive_items = extractList(additives_tags_json, '', item => {{
-            return item ? item.replace(/^en:/, '') : null;
-        }});
-        if (additive_items) {{
-            summary_parts.push(product_name + " has the following additives: " + additive_items + ".");
-        }}
-
-        // Part 4: Nutriments
-        const nutriment_items = extractList(nutriments_json, '', item => {{
-            // The item here is the full element wrapper, e.g., {{ "element": {{ "name": "fat", ... }} }}
-            const nutriment = item; // The data is directly in the item for nutriments
-            console.log("Processing nutriment item: " + JSON.stringify(nutriment)); // Logs to Cloud Logging
-            if (nutriment && nutriment.name && nutriment.value && nutriment.unit && nutriment.name !== 'energy') {{
-                const name = nutriment.name.replace(/_/g, ' ');
-                const capitalized_name = name.charAt(0).toUpperCase() + name.slice(1);
-                return `${{capitalized_name}}: ${{nutriment.value}} ${{nutriment.unit}}`; // Note: template literal braces are already escaped
-            }}
-            return null;
-        }});
-        if (nutriment_items) {{
-            summary_parts.push(product_name + " contains " + nutriment_items + ".");
-        }}
-
-        // Part 5: Nutri-Score
-        if (nutriscore_grade_str && nutriscore_grade_str.trim() !== '') {{
-            const grade = nutriscore_grade_str.toUpperCase();
-            summary_parts.push("It has a Nutri-Score grade of " + grade + ".");
-        }} else {{
-            summary_parts.push("It has an unknown Nutri-Score grade.");
-        }}
-
-        // Part 6: Nova Group
-        if (nova_group_val && nova_group_val.trim() !== '' && nova_group_val.trim() !== 'null') {{
-            summary_parts.push("It has a Nova group classification of " + nova_group_val + ".");
-        }} else {{
-            summary_parts.push("It has an unknown Nova group classification.");
-        }}
-
-        return summary_parts.length > 0 ? summary_parts.join(' ') : "No summary available.";
-        '''
-
-        """).strip() + ";"
-
-def build_insert_query(source_table: str, destination_table: str) -> str:
-    """Builds the BigQuery SQL script to insert data using the UDF."""
+def build_destination_job_config(table_id: str) -> bigquery.QueryJobConfig:
+    """Builds a job config that writes query results straight into the destination table."""
+    return bigquery.QueryJobConfig(
+        destination=table_id,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED,
+        # Cluster on code so lookups and joins by product code prune blocks,
+        # and partition by ingestion day so reprocessing can target a date.
+        clustering_fields=["code"],
+        time_partitioning=bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY),
+    )
+
+def ensure_filtered_view(client: bigquery.Client, source_table: str, dataset: str) -> str:
+    """Creates the materialized view of summarizable products if needed and returns its ID."""
+    # Name the view after its source so a different --source-table gets its own view.
+    view_id = f"{dataset}.{source_table.rsplit('.', 1)[-1]}_filtered_mv"
+    query = textwrap.dedent(f"""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS `{view_id}`
+        CLUSTER BY code
+        AS
+        SELECT
+            code,
+            product_name,
+            nutriments,
+            ingredients_text,
+            categories_tags,
+            additives_tags,
+            nutriscore_grade,
+            nova_group
+        FROM `{source_table}`
+        WHERE ARRAY_LENGTH(product_name.list) > 0
+          AND ARRAY_LENGTH(nutriments.list) > 0
+    """)
+    client.query(query).result()
+    print(f"Materialized view {view_id} is ready.")
+    return view_id
+
+def ensure_vector_index(client: bigquery.Client, table_id: str):
+    """Creates the IVF cosine vector index used by search.py if it does not exist."""
+    query = textwrap.dedent(f"""
+        CREATE VECTOR INDEX IF NOT EXISTS prod_emb_idx
+        ON `{table_id}`(text_embedding)
+        OPTIONS(index_type = 'IVF', distance_type = 'COSINE')
+    """)
+    client.query(query).result()
+    print(f"Vector index prod_emb_idx on {table_id} is ready.")
+
+def build_summary_query(source_table: str, model_path: str, destination_table: Optional[str] = None) -> str:
+    """
+    Builds the BigQuery SQL that generates summaries with native SQL and embeds them.
+
+    If destination_table is given, only summaries that are new, changed, or still missing
+    an embedding in it are sent to the embedding model.
+    """
+    changed_filter = ""
+    if destination_table:
+        changed_filter = textwrap.dedent(f"""
+            LEFT JOIN (
+                -- Tables built by the old append-only INSERT may hold duplicate codes.
+                SELECT * FROM `{destination_table}`
+                WHERE TRUE
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY code) = 1
+            ) AS Existing ON Existing.code = Summaries.code
+            WHERE Existing.code IS NULL
+               OR Existing.summary IS DISTINCT FROM Summaries.summary
+               OR ARRAY_LENGTH(Existing.text_embedding) = 0
+        """).strip().replace("\n", "\n" + " " * 16)
     return textwrap.dedent(f"""
-        INSERT INTO `{destination_table}` (code, product_name, summary)
-        WITH FilteredProducts AS (
-            SELECT
-                code,
-                product_name,
-                product_name.list[OFFSET(0)].element.text AS extracted_product_name,
-                nutriments,
-                ingredients_text,
-                categories_tags,
-                additives_tags,
-                nutriscore_grade,
-                nova_group
-            FROM `{source_table}`
-            WHERE ARRAY_LENGTH(product_name.list) > 0
-              AND ARRAY_LENGTH(nutriments.list) > 0
-        )
         SELECT
             code,
-            extracted_product_name,
-            generate_summary(
-                TO_JSON_STRING(product_name),
-                TO_JSON_STRING(ARRAY(SELECT el.element FROM UNNEST(nutriments.list) AS el)),
-                TO_JSON_STRING(ingredients_text),
-                TO_JSON_STRING(categories_tags),
-                TO_JSON_STRING(additives_tags),
-                nutriscore_grade,
-                CAST(nova_group AS STRING)
-            ) AS generated_summary
-        FROM FilteredProducts;
+            product_name,
+            content AS summary,
+            ml_generate_embedding_result AS text_embedding
+        FROM ML.GENERATE_EMBEDDING(
+            MODEL `{model_path}`,
+            (
+                WITH SummaryParts AS (
+                    SELECT
+                        code,
+                        product_name.list[OFFSET(0)].element.text AS extracted_product_name,
+                        -- English product name, with a fallback.
+                        COALESCE(
+                            (SELECT el.element.text FROM UNNEST(product_name.list) AS el
+                             WHERE el.element.lang = 'en' AND el.element.text IS NOT NULL LIMIT 1),
+                            'This product'
+                        ) AS summary_name,
+                        (SELECT STRING_AGG(REPLACE(el.element, 'en:', ''), ', ')
+                         FROM UNNEST(categories_tags.list) AS el
+                         WHERE el.element IS NOT NULL) AS category_items,
+                        -- Prefer 'en' ingredients, falling back to any language.
+                        COALESCE(
+                            (SELECT STRING_AGG(el.element.text, ', ') FROM UNNEST(ingredients_text.list) AS el
+                             WHERE el.element.lang = 'en' AND el.element.text IS NOT NULL),
+                            (SELECT STRING_AGG(el.element.text, ', ') FROM UNNEST(ingredients_text.list) AS el
+                             WHERE el.element.text IS NOT NULL)
+                        ) AS ingredient_items,
+                        (SELECT STRING_AGG(REPLACE(el.element, 'en:', ''), ', ')
+                         FROM UNNEST(additives_tags.list) AS el
+                         WHERE el.element IS NOT NULL) AS additive_items,
+                        (SELECT STRING_AGG(
+                                    FORMAT('%s: %s %s',
+                                           INITCAP(REPLACE(el.element.name, '_', ' ')),
+                                           CAST(el.element.value AS STRING),
+                                           el.element.unit),
+                                    ', ')
+                         FROM UNNEST(nutriments.list) AS el
+                         WHERE el.element.name != 'energy'
+                           AND el.element.value IS NOT NULL
+                           AND el.element.unit IS NOT NULL) AS nutriment_items,
+                        NULLIF(TRIM(nutriscore_grade), '') AS nutriscore_grade,
+                        NULLIF(NULLIF(TRIM(CAST(nova_group AS STRING)), ''), 'null') AS nova_group
+                    FROM `{source_table}`
+                    -- Query-created tables leave code NULLABLE, and NULL codes never match in the MERGE.
+                    WHERE code IS NOT NULL
+                ),
+                Summaries AS (
+                    SELECT
+                        code,
+                        extracted_product_name AS product_name,
+                        -- ARRAY_TO_STRING skips NULL parts, so missing sections are simply omitted.
+                        ARRAY_TO_STRING([
+                            CONCAT(summary_name, ' belongs to ', category_items, ' category of products.'),
+                            CONCAT('Ingredients in ', summary_name, ' are ', ingredient_items, '.'),
+                            CONCAT(summary_name, ' has the following additives: ', additive_items, '.'),
+                            CONCAT(summary_name, ' contains ', nutriment_items, '.'),
+                            IFNULL(CONCAT('It has a Nutri-Score grade of ', UPPER(nutriscore_grade), '.'),
+                                   'It has an unknown Nutri-Score grade.'),
+                            IFNULL(CONCAT('It has a Nova group classification of ', nova_group, '.'),
+                                   'It has an unknown Nova group classification.')
+                        ], ' ') AS summary
+                    FROM SummaryParts
+                    -- MERGE needs at most one source row per code.
+                    WHERE TRUE
+                    QUALIFY ROW_NUMBER() OVER (PARTITION BY code) = 1
+                )
+                SELECT Summaries.code, Summaries.product_name, Summaries.summary AS content
+                FROM Summaries
+                {changed_filter}
+            ),
+            STRUCT(TRUE AS flatten_json_output)
+        )
+        -- Skip rows whose embedding failed; they are retried on the next run.
+        WHERE ml_generate_embedding_status = ''
+    """)
+
+def build_insert_query(source_table: str, destination_table: str, model_path: str) -> str:
+    """Builds the BigQuery SQL to upsert generated summaries and embeddings by code."""
+    summary_query = textwrap.indent(
+        build_summary_query(source_table, model_path, destination_table).strip(), " " * 12
+    )
+    return textwrap.dedent(f"""
+        MERGE `{destination_table}` T
+        USING (
+{summary_query}
+        ) S
+        ON T.code = S.code
+        WHEN MATCHED AND (T.summary IS DISTINCT FROM S.summary OR ARRAY_LENGTH(T.text_embedding) = 0) THEN
+            UPDATE SET summary = S.summary, product_name = S.product_name, text_embedding = S.text_embedding
+        WHEN NOT MATCHED THEN
+            INSERT (code, product_name, summary, text_embedding)
+            VALUES (S.code, S.product_name, S.summary, S.text_embedding);
     """)
 
 def process_product_data(project_id: str, dataset_id: str, source_table_id: str, destination_table_id: str):
     """
-    Reads product data, generates summaries, and inserts them into a destination table.
+    Reads product data, generates summaries and their embeddings, and writes them into a destination table.
 
     Args:
         project_id (str): Your Google Cloud project ID.
@@ -170,28 +198,41 @@ def process_product_data(project_id: str, dataset_id: str, source_table_id: str,
     client = bigquery.Client(project=project_id)
     destination_table_id_str = f"{project_id}.{dataset_id}.{destination_table_id}"
     source_table_id_str = f"{project_id}.{dataset_id}.{source_table_id}"
+    model_path_str = f"{project_id}.{dataset_id}.{EMBEDDING_MODEL_ID}"
 
-    ensure_destination_table(client, destination_table_id_str)
+    try:
+        table_exists = ensure_destination_table(client, destination_table_id_str)
+        filtered_view_id_str = ensure_filtered_view(client, source_table_id_str, f"{project_id}.{dataset_id}")
 
-    udf_query = build_summary_query(source_table_id_str, destination_table_id_str)
-    insert_query = build_insert_query(source_table_id_str, destination_table_id_str)
+        if table_exists:
+            # Incremental rebuild: upsert changed summaries with a MERGE.
+            query = build_insert_query(filtered_view_id_str, destination_table_id_str, model_path_str)
+            job_config = bigquery.QueryJobConfig()
+        else:
+            # First build: write the SELECT results directly, skipping DML.
+            query = build_summary_query(filtered_view_id_str, model_path_str)
+            job_config = build_destination_job_config(destination_table_id_str)
 
-    # Combine UDF creation and the INSERT statement into a single script.
-    full_query_script = f"{udf_query}\n{insert_query}"
+        print("--- Full BigQuery Script ---")
+        print(query)
+        print("----------------------------")
 
-    print("--- Full BigQuery Script ---")
-    print(full_query_script)
-    print("----------------------------")
+        # Dry run first to report how much the real query will scan.
+        dry_job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        dry_job = client.query(query, job_config=dry_job_config)
+        print(f"Will scan {dry_job.total_bytes_processed / 1e9:.2f} GB")
 
-    try:
-        print("Executing BigQuery script to create UDF and insert summaries...")
-        query_job = client.query(full_query_script)
+        print("Executing BigQuery script to write summaries...")
+        job_config.maximum_bytes_billed = MAX_BYTES_BILLED
+        query_job = client.query(query, job_config=job_config)
         query_job.result()  # Wait for the job to complete
 
-        print(f"Successfully inserted summaries into {destination_table_id_str}.")
+        print(f"Successfully wrote summaries into {destination_table_id_str}.")
         print(f"Job ID: {query_job.job_id}")
         if query_job.num_dml_affected_rows is not None:
-            print(f"Number of rows inserted: {query_job.num_dml_affected_rows}")
+            print(f"Number of rows inserted or updated: {query_job.num_dml_affected_rows}")
+
+        ensure_vector_index(client, destination_table_id_str)
     
     except api_core_exceptions.GoogleAPICallError as e:
         print(f"An error occurred while executing the BigQuery job: {e}")
@@ -1,9 +1,10 @@
 from google.cloud import bigquery
 from google.api_core.exceptions import NotFound
 
-def load_parquet_to_bigquery(project_id, dataset_id, table_id, gcs_uri):
+def load_gcs_to_bigquery(project_id, dataset_id, table_id, gcs_uri,
+                         source_format=bigquery.SourceFormat.PARQUET):
     """
-    Loads Parquet data from Google Cloud Storage into a BigQuery table.
+    Loads Parquet (or other supported) data from Google Cloud Storage into a BigQuery table.
 
     If the table already exists, the data will be appended.
     If you want to overwrite the table, change write_disposition to 'WRITE_TRUNCATE'.
@@ -13,13 +14,15 @@ def load_parquet_to_bigquery(project_id, dataset_id, table_id, gcs_uri):
         dataset_id (str): The ID of your BigQuery dataset.
         table_id (str): The ID of the destination table.
         gcs_uri (str): The URI of the Parquet files in GCS (e.g., 'gs://my-bucket/data/*.parquet').
+        source_format (str): The BigQuery source format. Use NEWLINE_DELIMITED_JSON for the
+            gzip-compressed scraper output; BigQuery decompresses .gz files automatically.
     """
     client = bigquery.Client(project=project_id)
     table_ref = client.dataset(dataset_id).table(table_id)
     
     # Configure the load job
     job_config = bigquery.LoadJobConfig()
-    job_config.source_format = bigquery.SourceFormat.PARQUET
+    job_config.source_format = source_format
     job_config.autodetect = True  # Automatically infer the schema
     
     # Use WRITE_TRUNCATE to overwrite the table, or WRITE_APPEND to add data.
@@ -55,5 +58,5 @@ if __name__ == '__main__':
     DATASET_ID = "Product_Staging"
     TABLE_ID = "product-staging"
     
-    load_parquet_to_bigquery(PROJECT_ID, DATASET_ID, TABLE_ID, GCS_URI)
+    load_gcs_to_bigquery(PROJECT_ID, DATASET_ID, TABLE_ID, GCS_URI)
 
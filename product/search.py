@@ -1,28 +1,77 @@
-import json
-import re
+import asyncio
+import collections
+import functools
+import hashlib
+import sys
+import threading
+import orjson
 from google.cloud import bigquery
+from google.api_core import exceptions as api_core_exceptions
 import vertexai # type: ignore
-from vertexai.preview.generative_models import GenerativeModel
+from vertexai.preview.generative_models import GenerationConfig, GenerativeModel
 
 # 1. Configuration - Update with your details
 PROJECT_ID = "phonic-raceway-481118-v0"
 LOCATION = "us-central1"
 DATASET_ID = "Product_Staging"
-TABLE_ID = "product_embeddings_final"
+TABLE_ID = "product_summaries_final" # Summaries and embeddings are built together
+CACHE_TABLE_ID = "search_rerank_cache"
 MODEL_PATH = f"`{PROJECT_ID}.{DATASET_ID}.my_text_embedding_model-004`"
+SUMMARY_PROMPT_CHARS = 500 # Summary prefix sent to Gemini per candidate
+RERANK_MEMO_SIZE = 1024 # Rerank results kept in memory per process
 
-# Initialize Clients
-vertexai.init(
-    project=PROJECT_ID,
-    location=LOCATION,
-    api_endpoint=f"{LOCATION}-aiplatform.googleapis.com")
-bq_client = bigquery.Client(project=PROJECT_ID)
-gemini_model = GenerativeModel("gemini-2.5-flash")
+# Response schema enforced by Gemini so the rerank output is always valid JSON
+RESULTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "code": {"type": "string"},
+                    "name": {"type": "string"},
+                    "explanation": {"type": "string"},
+                },
+                "required": ["code", "name", "explanation"],
+            },
+        },
+    },
+    "required": ["results"],
+}
+
+# Clients are created lazily on first use, so importing this module has no side effects.
+# lru_cache does not lock while building, so a lock keeps executor threads from racing.
+_client_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _bq():
+    return bigquery.Client(project=PROJECT_ID)
+
+def bq():
+    """Shared BigQuery client."""
+    with _client_lock:
+        return _bq()
+
+@functools.lru_cache(maxsize=1)
+def _gemini():
+    vertexai.init(
+        project=PROJECT_ID,
+        location=LOCATION,
+        api_endpoint=f"{LOCATION}-aiplatform.googleapis.com")
+    return GenerativeModel("gemini-2.5-flash")
+
+def gemini():
+    """Shared Gemini model, initializing Vertex AI on first use."""
+    with _client_lock:
+        return _gemini()
+
+_rerank_memo = collections.OrderedDict() # query_hash -> results, in LRU order
 
 def get_candidates(user_query, top_k=25):
     """Stage 1: Broad Vector Search in BigQuery."""
     query_sql = f"""
-    SELECT base.product_name, base.summary, base.code
+    SELECT base.code, base.product_name, SUBSTR(base.summary, 1, {SUMMARY_PROMPT_CHARS}) AS summary
     FROM VECTOR_SEARCH(
       TABLE `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`,
       'text_embedding',
@@ -30,25 +79,113 @@ def get_candidates(user_query, top_k=25):
         SELECT ml_generate_embedding_result AS text_embedding 
         FROM ML.GENERATE_EMBEDDING(MODEL {MODEL_PATH}, (SELECT @text AS content), STRUCT(TRUE AS flatten_json_output))
       ),
-      top_k => {top_k}
+      top_k => {top_k},
+      distance_type => 'COSINE',
+      options => '{{"fraction_lists_to_search": 0.05}}'
     )
     """
     job_config = bigquery.QueryJobConfig(
         query_parameters=[bigquery.ScalarQueryParameter("text", "STRING", user_query)]
     )
     #print(f"Executing query: {query_sql}")
-    results = bq_client.query(query_sql, job_config=job_config).to_dataframe()
-    return results.to_dict(orient="records")
+    rows = bq().query(query_sql, job_config=job_config).result()
+    # Keep the Gemini prompt small: strip whitespace and drop empty fields.
+    # Rows without a code cannot be cited or cached, so skip them.
+    return [
+        {key: value.strip() if isinstance(value, str) else value for key, value in row.items() if value is not None}
+        for row in rows
+        if row["code"] is not None
+    ]
+
+def ensure_rerank_cache_table():
+    """Creates the persistent rerank cache table if it does not exist."""
+    table = bigquery.Table(
+        f"{PROJECT_ID}.{DATASET_ID}.{CACHE_TABLE_ID}",
+        schema=[
+            bigquery.SchemaField("query_hash", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("response_json", "STRING", mode="NULLABLE"),
+            bigquery.SchemaField("created", "TIMESTAMP", mode="NULLABLE"),
+        ],
+    )
+    table.clustering_fields = ["query_hash"]
+    bq().create_table(table, exists_ok=True)
+
+def rerank_cache_key(user_query, candidates):
+    """Content hash of the query and the candidate set it is reranked against."""
+    codes = ",".join(sorted(str(c["code"]) for c in candidates))
+    return hashlib.sha256(f"{user_query}|{codes}".encode()).hexdigest()
+
+def get_cached_rerank(query_hash):
+    """Returns the cached rerank results for a hash, or None on a miss."""
+    query_sql = f"""
+    SELECT response_json
+    FROM `{PROJECT_ID}.{DATASET_ID}.{CACHE_TABLE_ID}`
+    WHERE query_hash = @h
+    LIMIT 1
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("h", "STRING", query_hash)]
+    )
+    try:
+        for row in bq().query(query_sql, job_config=job_config).result():
+            return orjson.loads(row.response_json)
+    except api_core_exceptions.GoogleAPICallError as e:
+        # A missing table or failed lookup is just a cache miss.
+        print(f"Warning: Rerank cache lookup failed, treating as a miss. Error: {e}")
+    return None
 
-def rerank_and_filter(user_query, candidates):
-    """Stage 2: LLM reasoning to filter against strict constraints."""
+def store_cached_rerank(query_hash, results):
+    """Persists rerank results so later processes can skip the Gemini call."""
+    query_sql = f"""
+    INSERT INTO `{PROJECT_ID}.{DATASET_ID}.{CACHE_TABLE_ID}` (query_hash, response_json, created)
+    VALUES (@h, @r, CURRENT_TIMESTAMP())
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("h", "STRING", query_hash),
+            bigquery.ScalarQueryParameter("r", "STRING", orjson.dumps(results).decode()),
+        ]
+    )
+    try:
+        try:
+            bq().query(query_sql, job_config=job_config).result()
+        except api_core_exceptions.NotFound:
+            # First write on a fresh dataset: create the table and retry once.
+            ensure_rerank_cache_table()
+            bq().query(query_sql, job_config=job_config).result()
+    except api_core_exceptions.GoogleAPICallError as e:
+        print(f"Warning: Failed to store rerank results in the cache. Error: {e}")
+
+async def rerank_and_filter(user_query, candidates):
+    """Stage 2: LLM reasoning to filter against strict constraints, cached per query and candidates."""
+    query_hash = rerank_cache_key(user_query, candidates)
+    if query_hash in _rerank_memo:
+        _rerank_memo.move_to_end(query_hash)
+        return _rerank_memo[query_hash]
+
+    # BigQuery calls are blocking, so keep them off the event loop.
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, get_cached_rerank, query_hash)
+    if results is None:
+        results = await generate_rerank(user_query, candidates)
+        if results is None:
+            return None
+        await loop.run_in_executor(None, store_cached_rerank, query_hash, results)
+
+    _rerank_memo[query_hash] = results
+    if len(_rerank_memo) > RERANK_MEMO_SIZE:
+        _rerank_memo.popitem(last=False)
+    return results
+
+async def generate_rerank(user_query, candidates):
+    """Asks Gemini to filter and rank the candidates for the user's request."""
     system_prompt = f"""
     You are an expert shopping assistant. I have a list of products retrieved from a search.
     
     User Request: "{user_query}"
     
     Candidates:
-    {json.dumps(candidates, indent=2)}
+    {orjson.dumps(candidates, option=orjson.OPT_INDENT_2).decode()}
     
     Instructions:
     1. Analyze the user's request. If it contains generic wellness terms (e.g., "healthy", "good", "nutritional"), you MUST base your assessment on the nutritional information and ingredients found in the 'summary' field for each product and nova-group. Do not rely solely on the product's name.
@@ -61,49 +198,51 @@ def rerank_and_filter(user_query, candidates):
     {{"results": [{{"code": "CODE", "name": "PRODUCT_NAME", "explanation": "Reasoning..."}}]}}
     """
     
-    response = gemini_model.generate_content(system_prompt)
-
-    # --- Robust JSON Parsing ---
-    json_str = None
-    # 1. Extract JSON block from markdown
-    match = re.search(r'```(json)?\s*(\{.*\})\s*```', response.text, re.DOTALL)
-    if match:
-        json_str = match.group(2)
-    else:
-        # 2. Fallback to finding the first and last curly brace
-        match = re.search(r'\{.*\}', response.text, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-
-    if not json_str:
-        print("Warning: Could not find a JSON block in the model's response.")
-        return None
+    response = await gemini().generate_content_async(
+        system_prompt,
+        # GenerationConfig converts the JSON-schema dict; a plain dict is passed to the proto as-is and rejected.
+        generation_config=GenerationConfig(response_mime_type="application/json", response_schema=RESULTS_SCHEMA),
+    )
 
     try:
-        return json.loads(json_str)
-    except json.JSONDecodeError:
-        # 3. Fallback for malformed JSON (e.g., single quotes)
-        print("Warning: Model returned malformed JSON. Attempting to fix and re-parse.")
-        try:
-            # Replace single quotes with double quotes for keys and string values
-            fixed_json_str = re.sub(r"'(.*?)'", r'"\1"', json_str)
-            return json.loads(fixed_json_str)
-        except json.JSONDecodeError as e:
-            print(f"Error: Failed to parse JSON even after attempting to fix it. Error: {e}")
-            print(f"Original response text:\n---\n{response.text}\n---")
-            return None
+        return orjson.loads(response.text)
+    except orjson.JSONDecodeError as e:
+        print(f"Error: Failed to parse the model's JSON response. Error: {e}")
+        print(f"Original response text:\n---\n{response.text}\n---")
+        return None
 
-# --- Main Execution -----
-user_input = "Healthy snacks"
+async def search(user_query):
+    """Runs both search stages for a single query."""
+    print(f"Searching for: {user_query}...")
+    loop = asyncio.get_running_loop()
+
+    # Step 1: Broad Recall
+    candidates = await loop.run_in_executor(None, get_candidates, user_query)
 
-print(f"Searching for: {user_input}...")
+    # Step 2: Precision Filtering
+    return await rerank_and_filter(user_query, candidates)
+
+async def search_all(user_queries):
+    """
+    Runs several queries concurrently, overlapping their BigQuery and Gemini round-trips.
+
+    A failed query yields its exception in place of results, leaving the others intact.
+    """
+    return await asyncio.gather(*(search(q) for q in user_queries), return_exceptions=True)
+
+# --- Main Execution -----
+if __name__ == "__main__":
+    user_inputs = sys.argv[1:] or ["Healthy snacks"]
 
-# Step 1: Broad Recall
-candidates = get_candidates(user_input)
+    ensure_rerank_cache_table()
 
-# Step 2: Precision Filtering
-final_results = rerank_and_filter(user_input, candidates)
+    all_results = asyncio.run(search_all(user_inputs))
 
-if final_results and 'results' in final_results:
-    for item in final_results['results']:
-        print(f"Code: {item['code']} | Name: {item['name']} | Reason: {item['explanation']}")
\ No newline at end of file
+    for user_input, final_results in zip(user_inputs, all_results):
+        print(f"Results for: {user_input}")
+        if isinstance(final_results, Exception):
+            print(f"Error: Search failed. Error: {final_results}")
+            continue
+        if final_results and 'results' in final_results:
+            for item in final_results['results']:
+                print(f"Code: {item['code']} | Name: {item['name']} | Reason: {item['explanation']}")
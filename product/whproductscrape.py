@@ -1,71 +1,154 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from google.cloud import bigquery, storage
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
 import json
+import threading
 import time
+import xml.etree.ElementTree as ET
+from load_data import load_gcs_to_bigquery
 
 # Configuration
 SITEMAP_URL = "https://www.wholefoodsmarket.com/sitemap/sitemap-products.xml"
 API_BASE = "https://www.wholefoodsmarket.com/api/products/category/"
+GCS_BUCKET = "phonic-raceway-481118-duckdb-data-20251214"
+OUTPUT_BLOB = "wholefoods_products.ndjson.gz"
+PROJECT_ID = "phonic-raceway-481118-v0"
+DATASET_ID = "Product_Staging"
+TABLE_ID = "wholefoods-staging"
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "Accept": "application/json"
 }
+PAGE_WORKERS = 8 # Concurrent page requests per category
+CATEGORY_WORKERS = 4 # Categories scraped concurrently
+REQUESTS_PER_SECOND = 4 # Be polite to the server
+MAX_ATTEMPTS = 3 # Tries per page before giving up on it
+RETRY_BACKOFF = 2 # Seconds, doubled after each failed attempt
+
+# Pooled session so requests reuse TCP/TLS connections across threads
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+class RateLimiter:
+    """Thread-safe limiter that spaces requests evenly at a fixed rate."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+RATE_LIMITER = RateLimiter(REQUESTS_PER_SECOND)
+WRITE_LOCK = threading.Lock() # Serializes writes from concurrent categories
 
 def get_category_slugs():
     print("Fetching sitemap...")
-    response = requests.get(SITEMAP_URL, headers=HEADERS)
-    soup = BeautifulSoup(response.content, "xml")
-    # Extracting the last part of the URL as the category 'slug'
-    urls = [loc.text for loc in soup.find_all("loc")]
-    # Filter for product category pages
-    categories = [url.split('/')[-1] for url in urls if "/products/" in url]
-    return list(set(categories))
-
-def scrape_category(slug):
-    all_products = []
-    offset = 0
-    limit = 60 # Whole Foods default page size
+    # Stream-parse the sitemap instead of building a full DOM
+    response = SESSION.get(SITEMAP_URL, headers=HEADERS, stream=True)
+    response.raw.decode_content = True
+    categories = set()
+    for _, elem in ET.iterparse(response.raw, events=("end",)):
+        if elem.tag.endswith("loc"):
+            url = elem.text
+            # Filter for product category pages, keeping the last part of the URL as the category 'slug'
+            if url and "/products/" in url:
+                categories.add(url.rsplit('/', 1)[-1])
+        elem.clear()
+    return list(categories)
+
+def fetch_page(slug, offset, limit):
+    # The internal API endpoint used by the "Load More" button
+    api_url = f"{API_BASE}{slug}?leafCategory={slug}&limit={limit}&offset={offset}"
+    print(f"  Scraping {slug} (Offset: {offset})...")
 
-    while True:
-        # The internal API endpoint used by the "Load More" button
-        api_url = f"{API_BASE}{slug}?leafCategory={slug}&limit={limit}&offset={offset}"
-        print(f"  Scraping {slug} (Offset: {offset})...")
-        
+    # Returns the page's products ([] past the end), or None if every attempt failed
+    for attempt in range(1, MAX_ATTEMPTS + 1):
         try:
-            response = requests.get(api_url, headers=HEADERS)
+            RATE_LIMITER.wait()
+            response = SESSION.get(api_url, headers=HEADERS)
             if response.status_code != 200:
-                break
-            
-            data = response.json()
-            products = data.get("results", [])
-            
-            if not products:
-                break
-            
+                raise requests.HTTPError(f"HTTP {response.status_code}")
+
+            products = response.json().get("results", [])
+
             # Print each product's full data to show progress
             for product in products:
                 print(f"    - Found: {json.dumps(product, indent=4)}")
 
-            all_products.extend(products)
-            offset += limit # Move to the next "page"
-            time.sleep(1) # Be polite to the server
-            
+            return products
+
         except Exception as e:
-            print(f"Error: {e}")
-            break
-            
-    return all_products
+            print(f"Error fetching {slug} (Offset: {offset}, attempt {attempt}/{MAX_ATTEMPTS}): {e}")
+            if attempt < MAX_ATTEMPTS:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    return None
+
+def write_products(out, slug, products):
+    # One compact JSON object per line (NDJSON), tagged with its category
+    lines = "".join(
+        json.dumps({**product, "_category": slug}, separators=(",", ":")) + "\n"
+        for product in products
+    )
+    with WRITE_LOCK:
+        out.write(lines)
+
+def scrape_category(slug, out):
+    product_count = 0
+    offset = 0
+    limit = 60 # Whole Foods default page size
+
+    # The API does not report a total count, so request pages in windows of
+    # PAGE_WORKERS offsets and stop at the first empty (or persistently failing) page.
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        while True:
+            offsets = range(offset, offset + PAGE_WORKERS * limit, limit)
+            pages = executor.map(lambda o: fetch_page(slug, o, limit), offsets)
+
+            done = False
+            for page_offset, products in zip(offsets, pages):
+                if products is None:
+                    print(f"Warning: giving up on {slug} at offset {page_offset}; later pages were not scraped.")
+                    done = True
+                    break
+                if not products:
+                    done = True
+                    break
+                write_products(out, slug, products)
+                product_count += len(products)
+
+            if done:
+                break
+            offset += PAGE_WORKERS * limit # Move to the next window of "pages"
+
+    return product_count
 
 # Main Execution
 if __name__ == "__main__":
     slugs = get_category_slugs()
-    full_database = {}
+    slugs = slugs[:5] # Testing with first 5 categories
+
+    # Stream products straight to GCS for BigQuery ingestion. ignore_flush lets the gzip and
+    # text wrappers flush on close; the writer only finalizes the upload on a clean exit and
+    # cancels it if the scrape raises, so no partial object lands in the bucket.
+    blob = storage.Client(project=PROJECT_ID).bucket(GCS_BUCKET).blob(OUTPUT_BLOB)
+    with blob.open("wb", ignore_flush=True) as raw, gzip.GzipFile(fileobj=raw, mode="wb") as gz, io.TextIOWrapper(gz, encoding="utf-8") as f:
+        with ThreadPoolExecutor(max_workers=CATEGORY_WORKERS) as executor:
+            product_counts = list(executor.map(lambda slug: scrape_category(slug, f), slugs))
 
-    for slug in slugs[:5]: # Testing with first 5 categories
-        full_database[slug] = scrape_category(slug)
+    gcs_uri = f"gs://{GCS_BUCKET}/{OUTPUT_BLOB}"
+    print(f"Success! Uploaded {sum(product_counts)} products from {len(slugs)} categories to {gcs_uri}.")
 
-    # Save to your product folder for BigQuery ingestion
-    with open("wholefoods_products.json", "w") as f:
-        json.dump(full_database, f, indent=4)
-    
-    print(f"Success! Saved data for {len(full_database)} categories.")
\ No newline at end of file
+    load_gcs_to_bigquery(
+        PROJECT_ID, DATASET_ID, TABLE_ID, gcs_uri,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    )
\ No newline at end of file